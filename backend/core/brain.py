@@ -1,50 +1,255 @@
-import ollama
-import json
-import tomli
+import time
+import asyncio
+from typing import Optional
+import msgspec
 from .logger import log
+from .config import get_config
+from .cache import TTLCache, SemanticIndex, encode_message, history_key
+from .toolbox import TOOLS_SCHEMA_JSON
+from .llm import get_client, get_chat_slots
 
 # --- Configuration Loading ---
-try:
-    with open("config.toml", "rb") as f:
-        config = tomli.load(f)
-except FileNotFoundError:
-    config = {}
-    log.warning("config.toml not found. Using default values.")
+config = get_config()
 
-OLLAMA_HOST = config.get("llm", {}).get("host", "http://localhost:11434")
-OLLAMA_MODEL = config.get("llm", {}).get("model", "llama3")
+OLLAMA_MODEL = config.get("llm", {}).get("model", "llama3:8b-instruct-q4_K_M")
 
+# --- Streaming ---
+# Tokens forwarded per stream frame: the first token goes out immediately, later frames
+# grow so that the per-send overhead is amortized over more tokens.
+STREAM_BATCH_SIZES = (1, 3, 9, 27, 50)
+# A partial batch is flushed once it is this old (in seconds), even if it is not full.
+STREAM_FLUSH_INTERVAL = 0.05
 
-class Brain:
-    def __init__(self, model: str = OLLAMA_MODEL):
-        self.model = model
-        self.client = ollama.AsyncClient(host=OLLAMA_HOST)
-        self.history = []
+# --- History Compaction ---
+# Once the conversation grows past either limit, older messages are folded into a summary
+# in the background, so the prompt the model re-reads on every step stays bounded.
+history_config = config.get("history", {})
+COMPACT_AFTER_MESSAGES = history_config.get("compact_after_messages", 20)
+# Counted over the older messages only: the recent ones below are never summarized.
+COMPACT_AFTER_TOKENS = history_config.get("compact_after_tokens", 6000)
+# The most recent messages are always kept verbatim.
+KEEP_RECENT_MESSAGES = history_config.get("keep_recent_messages", 6)
+# Messages that must have aged out of the recent window since the last summary before another
+# one is made, so a few large tool outputs do not trigger a re-summary on every step.
+COMPACT_MIN_NEW_MESSAGES = history_config.get("compact_min_new_messages", 4)
+SUMMARY_PREFIX = "Prior context summary: "
+# Hard sliding window behind the compaction: at most MAX_TURNS * 2 messages follow the system
+# prompt and the summary, if any. At least one turn is always kept.
+MAX_TURNS = max(1, history_config.get("max_turns", 20))
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an AI agent. Keep the user's goals, "
+    "decisions made, files and pages involved, and any results still needed. Be concise."
+)
+
+# --- Response Cache ---
+# Shared by all sessions: an identical conversation gets the reply the model gave last time.
+cache_config = config.get("cache", {})
+_response_cache = None
+if cache_config.get("enabled", True):
+    _response_cache = TTLCache(maxsize=cache_config.get("maxsize", 1000), ttl=cache_config.get("ttl", 3600))
 
-    def _get_system_prompt(self, tools_schema):
-        return f"""
+# Optional: match new tasks worded almost like a cached one, using Ollama embeddings.
+_semantic_index = None
+EMBEDDING_MODEL = cache_config.get("embedding_model", "nomic-embed-text")
+if _response_cache is not None and cache_config.get("semantic", False):
+    _semantic_index = SemanticIndex(threshold=cache_config.get("similarity_threshold", 0.95))
+
+
+# --- System Prompt ---
+# Built once at import from the static tool schema; every session starts with this exact string.
+SYSTEM_PROMPT = f"""
 You are a helpful AI assistant. Your goal is to solve the user's task by thinking step-by-step and using tools.
 You must always output your response in a valid JSON format.
 When the user gives you a new instruction, you must stop your current plan and address the new instruction.
 Available tools:
-{json.dumps(tools_schema, indent=2)}
+{TOOLS_SCHEMA_JSON}
 """
+# Token count of the prompt, passed to the server as the prefix to keep, so a long conversation
+# never pushes the system prompt out of the context. Overestimating only keeps part of the first
+# user message too, while underestimating leaves the end of the tool schema unprotected, so the
+# estimate assumes two characters per token: the schema is mostly JSON punctuation, which
+# tokenizes far denser than the four characters per token of English prose.
+SYSTEM_PROMPT_TOKENS = len(SYSTEM_PROMPT) // 2
+# Added to an exact count for the chat template tokens around the system message.
+CHAT_TEMPLATE_TOKENS = 16
+_keep_tokens = None
+
+async def _system_prompt_tokens(client) -> int:
+    """Counts the prompt with the server's tokenizer once, if it has one, falling back to the estimate."""
+    global _keep_tokens
+    if _keep_tokens is None:
+        try:
+            count = await client.count_tokens(SYSTEM_PROMPT)
+        except Exception as e:
+            log.warning(f"Could not count the system prompt tokens, using an estimate: {e}")
+            count = None
+        _keep_tokens = count + CHAT_TEMPLATE_TOKENS if count else SYSTEM_PROMPT_TOKENS
+    return _keep_tokens
 
-    def initialize_history(self, toolbox):
-        tools_schema = toolbox.get_tools_json_schema()
-        system_prompt = self._get_system_prompt(tools_schema)
-        self.history = [{"role": "system", "content": system_prompt}]
+def _estimate_tokens(messages: list) -> int:
+    # Roughly four characters per token is close enough to decide when to compact.
+    return sum(len(message["content"]) for message in messages) // 4
+
+def _is_summary(message: dict) -> bool:
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+# --- Agent Replies ---
+class AgentStep(msgspec.Struct, omit_defaults=True):
+    """One reply from the model: a thought, or an action to run with its params."""
+    thought: Optional[str] = None
+    action: Optional[str] = None
+    params: Optional[dict] = None
+
+# Built once: decodes and type-checks a reply in a single pass.
+_step_decoder = msgspec.json.Decoder(AgentStep)
+
+
+class Brain:
+    def __init__(self, model: str = OLLAMA_MODEL):
+        self.model = model
+        self.client = get_client()
+        self.history = []
+        self._compaction_task = None
+
+    def close(self):
+        """Stops background work when the session ends, freeing its chat slot."""
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+
+    # The history is kept with a parallel list holding each message's canonical JSON encoding,
+    # computed once when the message is added, so hashing the conversation for the response
+    # cache never re-encodes it. Mutate it through the setter or the helpers below.
+    @property
+    def history(self) -> list:
+        return self._history
+
+    @history.setter
+    def history(self, messages: list):
+        self._history = list(messages)
+        self._encoded = [encode_message(message) for message in self._history]
+
+    def _append_message(self, role: str, content: str):
+        message = {"role": role, "content": content}
+        self._history.append(message)
+        self._encoded.append(encode_message(message))
+
+    def initialize_history(self):
+        # history[0] is never modified afterwards: keeping the prompt prefix byte-identical
+        # across steps lets Ollama skip re-processing it.
+        self.history = [{"role": "system", "content": SYSTEM_PROMPT}]
 
     def add_user_message(self, message: str):
-        self.history.append({"role": "user", "content": message})
+        self._append_message("user", message)
+
+    def _trim_history(self):
+        """Drops the oldest messages beyond the window, in case compaction has not kept up."""
+        # A summary right after the system prompt is the most compact context there is; keep it.
+        keep_from = 2 if len(self.history) > 1 and _is_summary(self.history[1]) else 1
+        excess = len(self.history) - keep_from - MAX_TURNS * 2
+        if excess <= 0:
+            return
+        log.info(f"Dropping {excess} old messages beyond the last {MAX_TURNS * 2}.")
+        del self._history[keep_from:keep_from + excess]
+        del self._encoded[keep_from:keep_from + excess]
+
+    def _maybe_compact_history(self):
+        """Starts a background summary of older messages once the history is too long."""
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+        old_messages = self.history[1:len(self.history) - KEEP_RECENT_MESSAGES]
+        # The summary from the previous pass leads the older messages; only the rest is new.
+        new_count = len(old_messages) - (1 if old_messages and _is_summary(old_messages[0]) else 0)
+        if new_count < max(COMPACT_MIN_NEW_MESSAGES, 1):
+            return
+        if len(self.history) <= COMPACT_AFTER_MESSAGES and _estimate_tokens(old_messages) <= COMPACT_AFTER_TOKENS:
+            return
+        self._compaction_task = asyncio.create_task(self._compact_history(old_messages))
 
-    async def step(self, last_action_result: str = None):
+    async def _compact_history(self, old_messages: list):
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in old_messages)
+        try:
+            async with get_chat_slots():
+                summary_text = await self.client.chat(self.model, [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}])
+        except Exception as e:
+            log.warning(f"History compaction failed, keeping the full history: {e}")
+            return
+        # Steps only append to the history, so the summarized messages are still right after
+        # the system prompt unless the history was reset meanwhile.
+        current = self.history[1:1 + len(old_messages)]
+        if len(current) != len(old_messages) or any(a is not b for a, b in zip(current, old_messages)):
+            return
+        summary = {"role": "system", "content": SUMMARY_PREFIX + summary_text}
+        self._history[1:1 + len(old_messages)] = [summary]
+        self._encoded[1:1 + len(old_messages)] = [encode_message(summary)]
+        log.info(f"Compacted {len(old_messages)} older messages into a summary.")
+
+    async def _embed(self, text: str):
+        try:
+            return await self.client.embed(EMBEDDING_MODEL, text)
+        except Exception as e:
+            log.warning(f"Embedding request failed, skipping semantic cache lookup: {e}")
+            return None
+
+    async def _stream_chat(self, on_delta=None) -> str:
+        """Streams the model's reply, forwarding it to `on_delta` in growing batches of tokens."""
+        keep_tokens = await _system_prompt_tokens(self.client)
+        async with get_chat_slots():
+            parts, batch = [], []
+            batch_index = 0
+            last_flush = time.monotonic()
+            async for token in self.client.stream_chat(self.model, self.history, json_mode=True, keep_tokens=keep_tokens):
+                parts.append(token)
+                if on_delta is None:
+                    continue
+                batch.append(token)
+                if len(batch) >= STREAM_BATCH_SIZES[batch_index] or time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                    await on_delta("".join(batch))
+                    batch.clear()
+                    batch_index = min(batch_index + 1, len(STREAM_BATCH_SIZES) - 1)
+                    last_flush = time.monotonic()
+            if batch:
+                await on_delta("".join(batch))
+            return "".join(parts)
+
+    async def step(self, last_action_result: str = None, on_delta=None):
+        """
+        Asks the model for the next step. If `on_delta` is given, it is awaited with chunks
+        of the reply as they are generated. Cancelling the call stops the generation.
+        """
         if last_action_result:
-            self.history.append({"role": "user", "content": f"Tool output: {last_action_result}"})
-        response = await self.client.chat(model=self.model, messages=self.history, options={"temperature": 0.1}, format="json")
-        response_content = response['message']['content']
-        self.history.append({"role": "assistant", "content": response_content})
+            self._append_message("user", f"Tool output: {last_action_result}")
+
+        response_content = None
+        key = embedding = None
+        if _response_cache is not None:
+            key = history_key(self.model, self._encoded)
+            response_content = _response_cache.get(key)
+        # Semantic matches are only safe for a fresh task (system prompt + one user message).
+        if response_content is None and _semantic_index is not None and len(self.history) == 2:
+            scope = history_key(self.model, self._encoded[:1])
+            embedding = await self._embed(self.history[-1]["content"])
+            if embedding is not None:
+                # Scanning every stored vector in pure Python is slow; keep it off the event loop.
+                response_content = await asyncio.to_thread(_semantic_index.lookup, scope, embedding)
+
+        index_reply = False
+        if response_content is not None:
+            log.info("Agent step served from the response cache.")
+        else:
+            response_content = await self._stream_chat(on_delta)
+            if key is not None:
+                _response_cache.set(key, response_content)
+            index_reply = embedding is not None
+
+        self._append_message("assistant", response_content)
+        self._trim_history()
+        self._maybe_compact_history()
         try:
-            return json.loads(response_content)
-        except json.JSONDecodeError:
-            return {"thought": response_content}
+            next_step = _step_decoder.decode(response_content)
+        except msgspec.DecodeError:
+            next_step = AgentStep(thought=response_content)
+        # Only thoughts are shared between similar tasks: a near-identical task can still name
+        # another file or other text to write, and replaying the action would run the wrong call.
+        if index_reply and next_step.action is None:
+            _semantic_index.add(scope, embedding, response_content)
+        return next_step
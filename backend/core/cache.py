@@ -0,0 +1,96 @@
+import time
+import math
+import operator
+import orjson
+import hashlib
+from collections import OrderedDict, deque
+
+
+class TTLCache:
+    """
+    A small LRU cache whose entries expire `ttl` seconds after being stored.
+    Used to reuse LLM replies for conversations the model has already answered.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def encode_message(message: dict) -> bytes:
+    """Encodes one history message canonically (sorted keys), so equal messages give equal bytes."""
+    return orjson.dumps(message, option=orjson.OPT_SORT_KEYS)
+
+
+def history_key(model: str, encoded_messages: list) -> str:
+    """
+    Returns a stable hash identifying a model and the exact conversation sent to it.
+    Takes the messages already encoded with `encode_message`, so callers can encode
+    each message once instead of the whole history on every lookup.
+    """
+    digest = hashlib.sha256(model.encode())
+    for message in encoded_messages:
+        # Encoded JSON never contains a raw newline, so it is an unambiguous separator.
+        digest.update(b"\n")
+        digest.update(message)
+    return digest.hexdigest()
+
+
+def _dot(a, b) -> float:
+    return sum(map(operator.mul, a, b))
+
+
+class SemanticIndex:
+    """
+    Keeps the most recent (embedding, value) pairs and returns the value of the
+    closest entry in the same scope when its cosine similarity reaches `threshold`.
+    Each entry's norm is computed once when it is added, so a lookup costs one dot
+    product per entry.
+    """
+
+    def __init__(self, maxsize: int = 256, threshold: float = 0.95):
+        self.threshold = threshold
+        self._entries = deque(maxlen=maxsize)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, scope: str, vector, value):
+        norm = math.sqrt(_dot(vector, vector))
+        if norm:
+            self._entries.append((scope, vector, norm, value))
+
+    def lookup(self, scope: str, vector):
+        norm = math.sqrt(_dot(vector, vector))
+        if not norm:
+            return None
+        best_value, best_score = None, self.threshold
+        # Scans a copy, so it can run in a worker thread while entries are added.
+        for entry_scope, entry_vector, entry_norm, value in tuple(self._entries):
+            if entry_scope != scope:
+                continue
+            score = _dot(vector, entry_vector) / (norm * entry_norm)
+            if score >= best_score:
+                best_value, best_score = value, score
+        return best_value
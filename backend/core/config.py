@@ -0,0 +1,25 @@
+import functools
+from .logger import log
+
+try:
+    import tomllib  # Python 3.11+
+except ModuleNotFoundError:
+    import tomli as tomllib
+
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> dict:
+    """
+    Loads config.toml once per process. Every module shares the parsed result,
+    so the file is read and parsed a single time at startup.
+    """
+    try:
+        with open("config.toml", "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        log.warning("config.toml not found. Using default values.")
+        return {}
+
+
+# Files the agent may not overwrite. A frozenset keeps the check in write_file O(1).
+PROTECTED_FILES = frozenset(get_config().get("security", {}).get("protected_files", []))
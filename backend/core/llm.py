@@ -0,0 +1,194 @@
+import asyncio
+import orjson
+from .config import get_config
+
+# --- Configuration Loading ---
+llm_config = get_config().get("llm", {})
+
+# Which server runs the model: "ollama", or "llama_server" for llama.cpp's OpenAI-compatible server.
+LLM_BACKEND = llm_config.get("backend", "ollama")
+OLLAMA_HOST = llm_config.get("host", "http://localhost:11434")
+# How long Ollama keeps the model (and its KV cache) loaded between requests.
+OLLAMA_KEEP_ALIVE = llm_config.get("keep_alive", "30m")
+LLAMA_SERVER_URL = llm_config.get("llama_server_url", "http://localhost:8080")
+
+
+# --- Clients ---
+# Both clients expose the same calls, so the Brain does not care which server it talks to:
+#   stream_chat(model, messages, json_mode) -> async iterator of text chunks
+#   chat(model, messages, json_mode)        -> the full reply text
+#   embed(model, text)                      -> an embedding vector
+#   prewarm(connections)                    -> opens that many pooled connections ahead of time
+#   preload(model)                          -> loads the model into memory before the first request
+#   count_tokens(text)                      -> the text's length in the model's tokens, or None if unknown
+# `keep_tokens` is the length of the static prompt prefix: when a conversation outgrows the
+# context window, the server drops messages after it rather than the prefix and its cached state.
+
+# Idle connections kept open to the model server, and for how long (in seconds), so steps
+# reuse a warm connection instead of opening a new one.
+KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 300
+# Seconds to wait for a connection to the model server, so an unreachable host fails fast.
+CONNECT_TIMEOUT = 5.0
+
+
+def _http_client(base_url: str):
+    import httpx
+    # No read timeout: generating a reply can legitimately take minutes. Connecting is capped.
+    # Bodies are encoded and decoded with orjson rather than httpx's stdlib json.
+    return httpx.AsyncClient(
+        base_url=base_url, timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT), headers={"Content-Type": "application/json"},
+        limits=httpx.Limits(max_keepalive_connections=KEEPALIVE_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY),
+    )
+
+
+async def _prewarm(http, path: str, connections: int):
+    """Opens `connections` pooled connections at once by sending that many concurrent cheap requests."""
+    responses = await asyncio.gather(*(http.get(path) for _ in range(connections)), return_exceptions=True)
+    for response in responses:
+        if isinstance(response, Exception):
+            raise response
+
+
+class OllamaClient:
+    """Talks to Ollama's REST API over a pooled keep-alive connection."""
+
+    def __init__(self, host: str):
+        self._http = _http_client(host)
+
+    async def prewarm(self, connections: int):
+        await _prewarm(self._http, "/", connections)
+
+    async def count_tokens(self, text: str):
+        return None  # Ollama has no tokenize endpoint
+
+    async def preload(self, model: str):
+        # A chat request without messages only loads the model.
+        body = {"model": model, "messages": [], "keep_alive": OLLAMA_KEEP_ALIVE}
+        response = await self._http.post("/api/chat", content=orjson.dumps(body))
+        response.raise_for_status()
+
+    def _chat_body(self, model: str, messages: list, json_mode: bool, temperature: float, keep_tokens: int, stream: bool) -> dict:
+        options = {"temperature": temperature}
+        if keep_tokens:
+            options["num_keep"] = keep_tokens
+        body = {"model": model, "messages": messages, "options": options, "keep_alive": OLLAMA_KEEP_ALIVE, "stream": stream}
+        if json_mode:
+            body["format"] = "json"
+        return body
+
+    async def stream_chat(self, model: str, messages: list, json_mode: bool = False, temperature: float = 0.1, keep_tokens: int = 0):
+        body = self._chat_body(model, messages, json_mode, temperature, keep_tokens, stream=True)
+        async with self._http.stream("POST", "/api/chat", content=orjson.dumps(body)) as response:
+            response.raise_for_status()
+            # One JSON object per line, the last one marked "done".
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                part = orjson.loads(line)
+                if "error" in part:
+                    raise RuntimeError(part["error"])
+                content = part.get("message", {}).get("content")
+                if content:
+                    yield content
+                if part.get("done"):
+                    break
+
+    async def chat(self, model: str, messages: list, json_mode: bool = False, temperature: float = 0.1, keep_tokens: int = 0) -> str:
+        body = self._chat_body(model, messages, json_mode, temperature, keep_tokens, stream=False)
+        response = await self._http.post("/api/chat", content=orjson.dumps(body))
+        response.raise_for_status()
+        return orjson.loads(response.content)["message"]["content"]
+
+    async def embed(self, model: str, text: str) -> list:
+        response = await self._http.post("/api/embed", content=orjson.dumps({"model": model, "input": text}))
+        response.raise_for_status()
+        return orjson.loads(response.content)["embeddings"][0]
+
+
+class LlamaServerClient:
+    """
+    Talks to llama.cpp's llama-server through its OpenAI-compatible API. Started with
+    `--parallel N --cont-batching`, it decodes the requests in its N slots in one batch.
+    """
+
+    def __init__(self, base_url: str):
+        self._http = _http_client(base_url)
+
+    async def prewarm(self, connections: int):
+        await _prewarm(self._http, "/health", connections)
+
+    async def preload(self, model: str):
+        pass  # llama-server loads its model when it starts
+
+    async def count_tokens(self, text: str):
+        response = await self._http.post("/tokenize", content=orjson.dumps({"content": text}))
+        response.raise_for_status()
+        return len(orjson.loads(response.content)["tokens"])
+
+    def _chat_body(self, model: str, messages: list, json_mode: bool, temperature: float, keep_tokens: int, stream: bool) -> dict:
+        # cache_prompt lets a slot reuse the KV cache of the prompt prefix it processed last time.
+        body = {"model": model, "messages": messages, "temperature": temperature, "stream": stream, "cache_prompt": True}
+        if json_mode:
+            body["response_format"] = {"type": "json_object"}
+        if keep_tokens:
+            body["n_keep"] = keep_tokens
+        return body
+
+    async def stream_chat(self, model: str, messages: list, json_mode: bool = False, temperature: float = 0.1, keep_tokens: int = 0):
+        body = self._chat_body(model, messages, json_mode, temperature, keep_tokens, stream=True)
+        async with self._http.stream("POST", "/v1/chat/completions", content=orjson.dumps(body)) as response:
+            response.raise_for_status()
+            # Server-sent events: one "data: {json}" line per chunk, ending with "data: [DONE]".
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                content = orjson.loads(data)["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+    async def chat(self, model: str, messages: list, json_mode: bool = False, temperature: float = 0.1, keep_tokens: int = 0) -> str:
+        body = self._chat_body(model, messages, json_mode, temperature, keep_tokens, stream=False)
+        response = await self._http.post("/v1/chat/completions", content=orjson.dumps(body))
+        response.raise_for_status()
+        return orjson.loads(response.content)["choices"][0]["message"]["content"]
+
+    async def embed(self, model: str, text: str) -> list:
+        response = await self._http.post("/v1/embeddings", content=orjson.dumps({"model": model, "input": text}))
+        response.raise_for_status()
+        return orjson.loads(response.content)["data"][0]["embedding"]
+
+
+_client = None
+
+def get_client():
+    """
+    Returns the process-wide LLM client for the configured backend. Sessions share its
+    connection pool, and their requests reach the server concurrently so it can batch them.
+    """
+    global _client
+    if _client is None:
+        if LLM_BACKEND == "llama_server":
+            _client = LlamaServerClient(LLAMA_SERVER_URL)
+        else:
+            _client = OllamaClient(OLLAMA_HOST)
+    return _client
+
+
+# --- Request Scheduling ---
+# The server batches concurrent requests together, up to its number of parallel slots
+# (OLLAMA_NUM_PARALLEL, or llama-server's --parallel); anything beyond that only waits in the
+# server's queue. Requests over the limit wait here instead, where a user interrupt can still
+# cancel them before they reach the server.
+LLM_PARALLEL_REQUESTS = llm_config.get("num_parallel", 4)
+_chat_slots = None
+
+def get_chat_slots() -> asyncio.Semaphore:
+    """Returns the semaphore bounding in-flight chat requests (created inside the running loop)."""
+    global _chat_slots
+    if _chat_slots is None:
+        _chat_slots = asyncio.Semaphore(LLM_PARALLEL_REQUESTS)
+    return _chat_slots
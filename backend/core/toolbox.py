@@ -1,19 +1,66 @@
 import os
+import orjson
 import asyncio
-from playwright.async_api import async_playwright, Playwright
+from pathlib import Path
+from typing import Optional
 from pydantic import BaseModel, ValidationError
 
 from .logger import log
-import tomli
+from .config import get_config, PROTECTED_FILES
 
 # --- Configuration Loading ---
-try:
-    with open("config.toml", "rb") as f:
-        config = tomli.load(f)
-except FileNotFoundError:
-    config = {}
-    log.warning("config.toml not found in toolbox. Using default values for security.")
-PROTECTED_FILES = config.get("security", {}).get("protected_files", [])
+browser_config = get_config().get("browser", {})
+# Optional CDP endpoint connected to at server startup, so the first attach finds it ready.
+DEFAULT_CDP_URL = browser_config.get("cdp_url")
+
+
+# --- Path Validation ---
+_PATH_ERROR = "Error: Access outside the working directory is not allowed."
+
+def _safe_resolve(path: str, base: Path) -> Optional[Path]:
+    """
+    Resolves `path` against `base`, following symlinks and `..` components.
+    Returns the absolute path, or None if it ends up outside `base`.
+    """
+    full_path = (base / path).resolve()
+    return full_path if full_path.is_relative_to(base) else None
+
+def _list_dir(path: Path) -> str:
+    # scandir reads the entries in one pass without building an intermediate list.
+    with os.scandir(path) as entries:
+        return "\n".join(entry.name for entry in entries)
+
+def _clean_text(text: str, max_chars: int) -> str:
+    # Rendered text is full of blank lines and runs of spaces left by the layout; dropping
+    # them fits more of the page into the same number of prompt tokens.
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)[:max_chars]
+
+def _read_text(path: Path) -> str:
+    with path.open('r') as f: return f.read()
+
+def _write_text(path: Path, content: str):
+    with path.open('w') as f: f.write(content)
+
+
+# --- In-Page Scripts ---
+# Types into a field and clicks submit in one round-trip. The value is set through the native
+# setter and announced with input/change events, so framework-controlled inputs see it too.
+# Unlike Playwright's click, the submit click skips actionability checks and pointer events,
+# so it only runs when the submit control is enabled and rendered; otherwise the Playwright
+# path is used.
+_TYPE_AND_SUBMIT_JS = """([typeSelector, text, submitSelector]) => {
+    const field = document.querySelector(typeSelector);
+    const submit = document.querySelector(submitSelector);
+    if (!field || !submit || !('value' in field) || submit.disabled || !submit.getClientRects().length) return 'missing';
+    if (field.type === 'password') return 'password';
+    field.focus();
+    Object.getOwnPropertyDescriptor(Object.getPrototypeOf(field), 'value').set.call(field, text);
+    field.dispatchEvent(new Event('input', {bubbles: true}));
+    field.dispatchEvent(new Event('change', {bubbles: true}));
+    submit.click();
+    return 'submitted';
+}"""
 
 
 # --- Pydantic Models for Input Validation ---
@@ -49,37 +96,102 @@ class BrowserWaitForResponseArgs(BaseModel):
     selector: str
     timeout: int = 30000
 
+class BrowserExtractTextArgs(BaseModel):
+    selector: str = "body"
+    max_chars: int = 8000
+
+
+# --- Tool Schema ---
+# Static, so it is built and serialized once at import instead of per session.
+# The serialized form is embedded verbatim at the start of every conversation, which lets
+# Ollama reuse its KV cache for that prefix. Keys are sorted so the bytes only change when
+# the schema itself does; treat tool descriptions as append-only to keep the prefix stable.
+# It is encoded compactly: indentation would only add prompt tokens the model has to read.
+TOOLS_SCHEMA = {
+    "list_files": { "description": "Lists files in a directory.", "params": {"path": {"type": "string"}}},
+    "read_file": { "description": "Reads a file.", "params": {"path": {"type": "string"}}},
+    "write_file": { "description": "Writes to a file.", "params": {"path": {"type": "string"}, "content": {"type": "string"}}},
+    "browser_attach": { "description": "Attaches to a user's running browser via CDP endpoint.", "params": {"cdp_url": {"type": "string"}}},
+    "browser_navigate": { "description": "Navigates to a URL.", "params": {"url": {"type": "string"}}},
+    "browser_click": { "description": "Clicks an element on the page.", "params": {"selector": {"type": "string"}}},
+    "browser_type_text": { "description": "Types text into an element.", "params": {"selector": {"type": "string"}, "text": {"type": "string"}}},
+    "browser_type_and_submit": { "description": "Types text and clicks a submit button.", "params": {"type_selector": {"type": "string"}, "text": {"type": "string"}, "submit_selector": {"type": "string"}}},
+    "browser_wait_for_response": { "description": "Waits for a specific element to appear on the page.", "params": {"selector": {"type": "string"}, "timeout": {"type": "integer", "description": "Timeout in milliseconds"}}},
+    "browser_extract_text": { "description": "Extracts the visible text of an element, the whole page by default.", "params": {"selector": {"type": "string"}, "max_chars": {"type": "integer", "description": "Maximum characters returned"}}},
+    "finish_task": { "description": "Call when the task is complete.", "params": {"reason": {"type": "string"}}}
+}
+TOOLS_SCHEMA_JSON = orjson.dumps(TOOLS_SCHEMA, option=orjson.OPT_SORT_KEYS).decode()
+
+
+# --- Shared Browser Connections ---
+class PlaywrightPool:
+    """
+    Holds one Playwright driver and one CDP connection per browser endpoint for the whole
+    process. Sessions open their own contexts on the shared browser instead of each
+    starting Playwright and connecting again; the connections are closed at shutdown.
+    """
+    def __init__(self):
+        self._playwright = None
+        self._browsers = {}
+        self._lock: asyncio.Lock | None = None
+
+    async def get_browser(self, cdp_url: str):
+        """Returns the shared browser for `cdp_url`, starting Playwright and connecting on first use."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            browser = self._browsers.get(cdp_url)
+            if browser is None or not browser.is_connected():
+                if self._playwright is None:
+                    # Deferred: most sessions never touch the browser, so Playwright is imported on first use
+                    from playwright.async_api import async_playwright
+                    self._playwright = await async_playwright().start()
+                browser = await self._playwright.chromium.connect_over_cdp(cdp_url)
+                self._browsers[cdp_url] = browser
+            return browser
+
+    async def close(self):
+        for browser in self._browsers.values():
+            try:
+                await browser.close()
+            except Exception as e:
+                log.warning(f"Error closing browser connection: {e}")
+        self._browsers.clear()
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+playwright_pool = PlaywrightPool()
+
 
 class Toolbox:
     def __init__(self):
-        self.playwright: Playwright | None = None
         self.browser = None
         self.page = None
-        # Mapping tool names to their Pydantic validation models
-        self.tool_validators = {
-            "list_files": ListFilesArgs,
-            "read_file": ReadFileArgs,
-            "write_file": WriteFileArgs,
-            "browser_attach": BrowserAttachArgs,
-            "browser_navigate": BrowserNavigateArgs,
-            "browser_click": BrowserClickArgs,
-            "browser_type_text": BrowserTypeTextArgs,
-            "browser_type_and_submit": BrowserTypeAndSubmitArgs,
-            "browser_wait_for_response": BrowserWaitForResponseArgs,
+        # The browser is shared with other sessions; this context and its one page belong to this
+        # toolbox. Tool calls run one at a time per session, so they all act on that page.
+        self._context = None
+        # Built once per toolbox: tool name -> (bound method, Pydantic model validating its
+        # params). Every tool is a coroutine, so dispatch always awaits.
+        self._tool_map = {
+            "list_files": (self.list_files, ListFilesArgs),
+            "read_file": (self.read_file, ReadFileArgs),
+            "write_file": (self.write_file, WriteFileArgs),
+            "browser_attach": (self.browser_attach, BrowserAttachArgs),
+            "browser_navigate": (self.browser_navigate, BrowserNavigateArgs),
+            "browser_click": (self.browser_click, BrowserClickArgs),
+            "browser_type_text": (self.browser_type_text, BrowserTypeTextArgs),
+            "browser_type_and_submit": (self.browser_type_and_submit, BrowserTypeAndSubmitArgs),
+            "browser_wait_for_response": (self.browser_wait_for_response, BrowserWaitForResponseArgs),
+            "browser_extract_text": (self.browser_extract_text, BrowserExtractTextArgs),
         }
 
-    async def _ensure_playwright(self):
-        if self.playwright is None:
-            self.playwright = await async_playwright().start()
-
     async def browser_attach(self, cdp_url: str):
-        await self._ensure_playwright()
         try:
-            self.browser = await self.playwright.chromium.connect_over_cdp(cdp_url)
-            if self.browser.contexts() and self.browser.contexts()[0].pages:
-                 self.page = self.browser.contexts()[0].pages[0]
-            else:
-                 self.page = await self.browser.new_page()
+            await self._close_context()  # Re-attaching starts from a fresh context
+            self.browser = await playwright_pool.get_browser(cdp_url)
+            self._context = await self.browser.new_context()
+            self.page = await self._context.new_page()
             return "Successfully attached to the browser."
         except Exception as e:
             return f"Error attaching to browser: {e}."
@@ -94,9 +206,11 @@ class Toolbox:
     async def browser_click(self, selector: str):
         if not self.page: return "Error: Not attached to a browser."
         element = self.page.locator(selector).first
-        if await element.get_attribute("type") == "password":
-            return "PAUSE: Password field detected."
         try:
+            if await element.get_attribute("type") == "password":
+                return "PAUSE: Password field detected."
+            # Playwright's click waits until the element is visible, enabled and stable, and
+            # sends real pointer and mouse events; a click() from page JS would do neither.
             await element.click()
             return f"Clicked on '{selector}'."
         except Exception as e: return f"Error clicking element: {e}"
@@ -112,6 +226,14 @@ class Toolbox:
         except Exception as e: return f"Error typing text: {e}"
 
     async def browser_type_and_submit(self, type_selector: str, text: str, submit_selector: str):
+        if not self.page: return "Error: Not attached to a browser."
+        try:
+            outcome = await self.page.evaluate(_TYPE_AND_SUBMIT_JS, [type_selector, text, submit_selector])
+        except Exception:
+            outcome = None  # Not plain CSS selectors, e.g. "text=Submit"
+        if outcome == "password": return "PAUSE: Password field detected."
+        if outcome == "submitted": return "Successfully typed and submitted."
+        # Fall back to Playwright's locators, which wait for elements that are not there yet.
         type_result = await self.browser_type_text(type_selector, text)
         if "PAUSE" in type_result or "Error" in type_result: return type_result
         click_result = await self.browser_click(submit_selector)
@@ -125,77 +247,69 @@ class Toolbox:
             return f"Element '{selector}' appeared."
         except Exception as e: return f"Error waiting for '{selector}': {e}"
 
-    async def browser_extract_text(self):
+    async def browser_extract_text(self, selector: str = "body", max_chars: int = 8000):
         if not self.page: return "Error: Not attached to a browser."
         try:
-            return await self.page.content()
+            # Rendered text rather than the page's HTML: the result goes into every later prompt.
+            text = await self.page.locator(selector).first.inner_text()
+            # Large pages take a while to clean up; keep that off the event loop.
+            return await asyncio.to_thread(_clean_text, text, max_chars)
         except Exception as e: return f"Error extracting text: {e}"
 
+    async def _close_context(self):
+        context, self._context = self._context, None
+        self.page = None
+        if context:
+            try:
+                await context.close()
+            except Exception as e:
+                log.warning(f"Error closing browser context: {e}")
+
     async def disconnect(self):
-        if self.browser:
-            await self.browser.close()
-            self.browser = None
-        if self.playwright:
-            await self.playwright.stop()
-            self.playwright = None
-
-    def list_files(self, path: str = "."):
-        if ".." in path or path.startswith("/"): return "Error: Access to parent or absolute directories is not allowed."
+        # Only this session's context is closed; the shared browser connection stays open.
+        await self._close_context()
+        self.browser = None
+
+    # File I/O runs in a worker thread so a slow disk never blocks the event loop,
+    # which serves every other session.
+    async def list_files(self, path: str = "."):
         try:
-            return "\n".join(os.listdir(path))
+            full_path = _safe_resolve(path, Path.cwd().resolve())
+            if full_path is None: return _PATH_ERROR
+            return await asyncio.to_thread(_list_dir, full_path)
         except Exception as e: return f"Error listing files: {e}"
 
-    def read_file(self, path: str):
-        if ".." in path or path.startswith("/"): return "Error: Access to parent or absolute directories is not allowed."
+    async def read_file(self, path: str):
         try:
-            with open(path, 'r') as f: return f.read()
+            full_path = _safe_resolve(path, Path.cwd().resolve())
+            if full_path is None: return _PATH_ERROR
+            return await asyncio.to_thread(_read_text, full_path)
         except Exception as e: return f"Error reading file: {e}"
 
-    def write_file(self, path: str, content: str):
-        if ".." in path or path.startswith("/"): return "Error: Access to parent or absolute directories is not allowed."
-        if os.path.exists(path) and path in PROTECTED_FILES: return f"Error: Overwriting '{path}' is not allowed."
+    async def write_file(self, path: str, content: str):
         try:
-            with open(path, 'w') as f: f.write(content)
+            base = Path.cwd().resolve()
+            full_path = _safe_resolve(path, base)
+            if full_path is None: return _PATH_ERROR
+            # Compare the normalized relative path, so "./config.toml" is protected too.
+            if str(full_path.relative_to(base)) in PROTECTED_FILES and full_path.exists(): return f"Error: Overwriting '{path}' is not allowed."
+            await asyncio.to_thread(_write_text, full_path, content)
             return f"File '{path}' written successfully."
         except Exception as e: return f"Error writing file: {e}"
 
     def get_tools_json_schema(self):
-        # ... (same as before)
-        return {
-            "list_files": { "description": "Lists files in a directory.", "params": {"path": {"type": "string"}}},
-            "read_file": { "description": "Reads a file.", "params": {"path": {"type": "string"}}},
-            "write_file": { "description": "Writes to a file.", "params": {"path": {"type": "string"}, "content": {"type": "string"}}},
-            "browser_attach": { "description": "Attaches to a user's running browser via CDP endpoint.", "params": {"cdp_url": {"type": "string"}}},
-            "browser_navigate": { "description": "Navigates to a URL.", "params": {"url": {"type": "string"}}},
-            "browser_click": { "description": "Clicks an element on the page.", "params": {"selector": {"type": "string"}}},
-            "browser_type_text": { "description": "Types text into an element.", "params": {"selector": {"type": "string"}, "text": {"type": "string"}}},
-            "browser_type_and_submit": { "description": "Types text and clicks a submit button.", "params": {"type_selector": {"type": "string"}, "text": {"type": "string"}, "submit_selector": {"type": "string"}}},
-            "browser_wait_for_response": { "description": "Waits for a specific element to appear on the page.", "params": {"selector": {"type": "string"}, "timeout": {"type": "integer", "description": "Timeout in milliseconds"}}},
-            "browser_extract_text": { "description": "Extracts HTML content from the page.", "params": {}},
-            "finish_task": { "description": "Call when the task is complete.", "params": {"reason": {"type": "string"}}}
-        }
+        return TOOLS_SCHEMA
 
     async def execute_tool(self, tool_name: str, params: dict):
-        # --- NEW VALIDATION LOGIC ---
-        if tool_name in self.tool_validators:
-            validator = self.tool_validators[tool_name]
-            try:
-                # Validate and get the coerced parameters
-                validated_params = validator(**params).dict()
-                params = validated_params
-            except ValidationError as e:
-                log.warning(f"Tool {tool_name} validation failed for params: {params}. Error: {e}")
-                return f"Error: Invalid parameters for tool '{tool_name}'. {e}"
-
-        tool_map = {
-            "list_files": self.list_files, "read_file": self.read_file, "write_file": self.write_file,
-            "browser_attach": self.browser_attach, "browser_navigate": self.browser_navigate,
-            "browser_click": self.browser_click, "browser_type_text": self.browser_type_text,
-            "browser_type_and_submit": self.browser_type_and_submit,
-            "browser_wait_for_response": self.browser_wait_for_response,
-            "browser_extract_text": self.browser_extract_text,
-        }
-        if tool_name not in tool_map: raise ValueError(f"Unknown tool: {tool_name}")
+        tool = self._tool_map.get(tool_name)
+        if tool is None: raise ValueError(f"Unknown tool: {tool_name}")
+
+        tool_function, validator = tool
+        try:
+            # Validate and get the coerced parameters
+            params = validator(**params).dict()
+        except ValidationError as e:
+            log.warning(f"Tool {tool_name} validation failed for params: {params}. Error: {e}")
+            return f"Error: Invalid parameters for tool '{tool_name}'. {e}"
 
-        tool_function = tool_map[tool_name]
-        return await tool_function(**params) if asyncio.iscoroutinefunction(tool_function) else tool_function(**params)
+        return await tool_function(**params)
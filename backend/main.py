@@ -1,24 +1,121 @@
 import uvicorn
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 import asyncio
+import orjson
+import msgspec
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from .core.brain import Brain
-from .core.toolbox import Toolbox
+from .core.brain import Brain, OLLAMA_MODEL
+from .core.llm import get_client, LLM_PARALLEL_REQUESTS
+from .core.toolbox import Toolbox, playwright_pool, DEFAULT_CDP_URL
 from .core.logger import log
+from .core.config import get_config
+
+server_config = get_config().get("server", {})
+# Agent sessions allowed at once; each one holds a browser context and issues LLM calls.
+MAX_AGENTS = server_config.get("max_agents", 8)
+# Threads running blocking work (file I/O, page text cleanup) for all sessions together.
+WORKER_THREADS = server_config.get("worker_threads", 4)
+
+# Outgoing messages queued within this many seconds are sent together in one frame.
+SEND_BATCH_WINDOW = 0.005
+SEND_MAX_BATCH = 64
+
+# Fixed messages, encoded once at import instead of on every send.
+_MSG_STOPPED = orjson.dumps({"type": "status", "message": "Agent stopped by user."})
+_MSG_RESUMING = orjson.dumps({"type": "status", "message": "Agent is resuming."})
+_MSG_REPLANNING = orjson.dumps({"type": "status", "message": "Received new instruction, replanning..."})
+_MSG_SERVER_ERROR = orjson.dumps({"type": "error", "message": "An unexpected server error occurred."})
 
 # --- Helper Functions for WebSocket Logic ---
 
-async def handle_tool_result(result: str, brain: Brain, websocket: WebSocket) -> str:
+class WSSender:
+    """
+    Queues outgoing messages and sends each burst as a single frame holding a JSON array,
+    so the several messages produced by one agent step cost one WebSocket send.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def send(self, data):
+        """Encodes a message (a dict or an AgentStep) with orjson and queues it for the next frame."""
+        self._queue.put_nowait(orjson.dumps(data, default=msgspec.to_builtins))
+
+    def send_encoded(self, message: bytes):
+        """Queues a message that is already JSON-encoded, such as the fixed _MSG_* messages."""
+        self._queue.put_nowait(message)
+
+    async def close(self):
+        """Sends anything still queued, then stops the background task."""
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(SEND_BATCH_WINDOW)
+            while len(batch) < SEND_MAX_BATCH and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                closing = True
+                batch = [message for message in batch if message is not None]
+            if not batch:
+                continue
+            try:
+                await self.websocket.send_bytes(b"[" + b",".join(batch) + b"]")
+            except Exception as e:
+                log.warning(f"Could not send to the WebSocket, dropping outgoing messages: {e}")
+                return
+
+async def receive_loop(websocket: WebSocket, queue: asyncio.Queue):
+    """Pushes every incoming message into the queue. A disconnect is forwarded as the exception itself."""
+    try:
+        while True:
+            queue.put_nowait(await websocket.receive_text())
+    except Exception as e:
+        queue.put_nowait(e)
+
+async def next_message(queue: asyncio.Queue) -> str:
+    """Waits for the next user message, re-raising any error seen by the receiver."""
+    message = await queue.get()
+    if isinstance(message, Exception):
+        raise message
+    return message
+
+class Inbox:
+    """
+    Hands out user messages from the receiver queue. `next` is one long-lived task waiting for
+    the next message, so the agent loop can race it against model steps without starting a
+    new receive on every step, and a message arriving at the end of a turn is never lost.
+    """
+    def __init__(self, queue: asyncio.Queue):
+        self._queue = queue
+        self.next = asyncio.create_task(next_message(queue))
+
+    async def receive(self) -> str:
+        """Waits for the next message and consumes it."""
+        message = await self.next
+        self.next = asyncio.create_task(next_message(self._queue))
+        return message
+
+    def close(self):
+        self.next.cancel()
+
+async def handle_tool_result(result: str, brain: Brain, sender: WSSender, inbox: Inbox) -> str:
     """Handles the result of a tool execution, including the pause/resume logic."""
     last_result = str(result)
-    await websocket.send_json({"type": "action_result", "output": last_result})
+    sender.send({"type": "action_result", "output": last_result})
 
     if last_result.startswith("PAUSE:"):
-        await websocket.send_json({"type": "pause", "message": last_result})
-        resume_msg = await websocket.receive_text()  # Wait for user to resume
+        sender.send({"type": "pause", "message": last_result})
+        resume_msg = await inbox.receive()  # Wait for user to resume
         if resume_msg == "resume":
             last_result = "User has handled the password field."
-            await websocket.send_json({"type": "status", "message": "Agent is resuming."})
+            sender.send_encoded(_MSG_RESUMING)
         else:
             # If the user sent something other than "resume", treat it as a new instruction
             brain.add_user_message(resume_msg)
@@ -26,26 +123,37 @@ async def handle_tool_result(result: str, brain: Brain, websocket: WebSocket) ->
 
     return last_result
 
-async def run_agent_inner_loop(brain: Brain, toolbox: Toolbox, websocket: WebSocket):
+async def run_agent_inner_loop(brain: Brain, toolbox: Toolbox, sender: WSSender, inbox: Inbox):
     """Runs the agent's think-act cycle until it finishes or is interrupted."""
+    async def send_delta(delta: str):
+        sender.send({"type": "stream", "delta": delta})
+
     last_result = None
     while True:
-        # Check for user interruption before the agent thinks
-        try:
-            interrupt_message = await asyncio.wait_for(websocket.receive_text(), timeout=0.01)
-            brain.add_user_message(interrupt_message)
-            await websocket.send_json({"type": "status", "message": "Received new instruction, replanning..."})
+        # Agent thinks of the next step, racing against a user interruption. A message that
+        # arrived while a tool ran is handled right away, without starting a step first.
+        step_task = None
+        if not inbox.next.done():
+            step_task = asyncio.create_task(brain.step(last_result, on_delta=send_delta))
+            try:
+                await asyncio.wait({step_task, inbox.next}, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                step_task.cancel()  # asyncio.wait leaves its tasks running when cancelled
+                raise
+
+        if inbox.next.done():
+            if step_task is not None:
+                step_task.cancel()
+            brain.add_user_message(await inbox.receive())
+            sender.send_encoded(_MSG_REPLANNING)
             break # Break inner loop to re-plan based on new message
-        except asyncio.TimeoutError:
-            pass # No interruption, continue
 
-        # Agent thinks of the next step
-        next_step = await brain.step(last_result)
-        await websocket.send_json(next_step)
+        next_step = step_task.result()
+        sender.send(next_step)
 
-        if "action" in next_step:
-            action = next_step["action"]
-            params = next_step.get("params", {})
+        if next_step.action is not None:
+            action = next_step.action
+            params = next_step.params or {}
 
             if action == "finish_task":
                 log.info(f"Task finished with reason: {params.get('reason')}")
@@ -53,21 +161,52 @@ async def run_agent_inner_loop(brain: Brain, toolbox: Toolbox, websocket: WebSoc
 
             try:
                 result = await toolbox.execute_tool(action, params)
-                last_result = await handle_tool_result(result, brain, websocket)
+                last_result = await handle_tool_result(result, brain, sender, inbox)
                 if last_result == "INTERRUPTED":
                     break # Break inner loop to re-plan
 
             except Exception as e:
                 log.error(f"Error executing tool {action}: {e}", exc_info=True)
                 last_result = f"Error executing tool {action}: {e}"
-                await websocket.send_json({"type": "error", "message": last_result})
+                sender.send({"type": "error", "message": last_result})
         else:
             # It was a thought, so no result to process
             last_result = None
 
 # --- FastAPI Application ---
 
-app = FastAPI()
+async def warm_up_model_server():
+    """Opens the model server connections and loads the model, so the first steps do not wait for either."""
+    try:
+        await get_client().prewarm(LLM_PARALLEL_REQUESTS)
+    except Exception as e:
+        log.warning(f"Could not reach the model server: {e}")
+        return  # Preloading would only wait out the same failure again
+    try:
+        await get_client().preload(OLLAMA_MODEL)
+    except Exception as e:
+        log.warning(f"Could not preload the model {OLLAMA_MODEL}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Created at startup so the semaphore belongs to the server's event loop.
+    app.state.agent_sem = asyncio.Semaphore(MAX_AGENTS)
+    # asyncio.to_thread runs on the default executor; bound it so load cannot spawn a thread per call.
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Best-effort, so it runs in the background: a slow or unreachable model host must not delay startup.
+    warm_up_task = asyncio.create_task(warm_up_model_server())
+    if DEFAULT_CDP_URL:
+        try:
+            await playwright_pool.get_browser(DEFAULT_CDP_URL)
+        except Exception as e:
+            log.warning(f"Could not connect to the browser at {DEFAULT_CDP_URL}: {e}")
+    yield
+    warm_up_task.cancel()
+    await playwright_pool.close()
+    executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 
 @app.websocket("/ws/execute_task")
 async def execute_task_ws(websocket: WebSocket):
@@ -75,35 +214,54 @@ async def execute_task_ws(websocket: WebSocket):
     await websocket.accept()
     log.info("WebSocket connection accepted.")
 
+    # Reject rather than queue sessions over the limit, so running sessions keep their latency.
+    agent_sem = websocket.app.state.agent_sem
+    if agent_sem.locked():
+        log.warning("Too many agent sessions, rejecting the connection.")
+        await websocket.close(code=1013)  # Try Again Later
+        return
+
     brain = Brain()
     toolbox = Toolbox()
-    brain.initialize_history(toolbox)
+    brain.initialize_history()
+
+    # A single receiver feeds all incoming messages to the handler, so interrupts
+    # are noticed as soon as they arrive instead of by polling between steps.
+    queue = asyncio.Queue()
+    receiver_task = asyncio.create_task(receive_loop(websocket, queue))
+    inbox = Inbox(queue)
+    sender = WSSender(websocket)
+    await agent_sem.acquire()  # Free slot checked above; nothing has awaited since
 
     try:
         while True:
             # Wait for a user message to start or continue the conversation
-            user_message = await websocket.receive_text()
+            user_message = await inbox.receive()
             log.info(f"Received message from user: {user_message}")
 
             if user_message == "stop":
-                await websocket.send_json({"type": "status", "message": "Agent stopped by user."})
+                sender.send_encoded(_MSG_STOPPED)
                 break
 
             brain.add_user_message(user_message)
 
             # Start the agent's execution loop for this turn
-            await run_agent_inner_loop(brain, toolbox, websocket)
+            await run_agent_inner_loop(brain, toolbox, sender, inbox)
 
     except WebSocketDisconnect:
         log.info("Client disconnected.")
     except Exception as e:
         log.error(f"An unexpected error occurred in the main WebSocket handler: {e}", exc_info=True)
-        try:
-            await websocket.send_json({"type": "error", "message": f"An unexpected server error occurred."})
-        except Exception:
-            pass # Websocket might already be closed
+        # Dropped by the sender if the websocket is already closed
+        sender.send_encoded(_MSG_SERVER_ERROR)
     finally:
         log.info("Closing connection and cleaning up resources.")
+        receiver_task.cancel()
+        inbox.close()
+        brain.close()
+        # Released before any await, so a handler cancelled during cleanup cannot leak its slot.
+        agent_sem.release()
+        await sender.close()
         await toolbox.disconnect()
         if websocket.client_state != 'DISCONNECTED':
              await websocket.close()
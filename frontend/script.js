@@ -8,7 +8,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const resumeButton = document.getElementById('resume-button');
 
     let socket = null;
+    let streamDiv = null; // Live preview of the reply the model is generating
     let agentIsActive = false;
+    const decoder = new TextDecoder();
     let reconnectAttempts = 0;
     const maxReconnectAttempts = 5;
     const baseReconnectDelay = 1000; // 1 second
@@ -51,6 +53,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function connect(initialTask) {
         const uri = "ws://localhost:8000/ws/execute_task";
         socket = new WebSocket(uri);
+        socket.binaryType = 'arraybuffer'; // The backend sends JSON as binary frames
         setAgentState(true);
         addMessageToUI('جاري الاتصال بالوكيل...', 'agent status');
 
@@ -63,12 +66,10 @@ document.addEventListener('DOMContentLoaded', () => {
         };
 
         socket.onmessage = (event) => {
-            const data = JSON.parse(event.data);
-            if (data.type === 'pause') {
-                handlePause(data);
-            } else {
-                addMessageToUI(null, 'agent', data);
-            }
+            const text = typeof event.data === 'string' ? event.data : decoder.decode(event.data);
+            // The backend batches messages sent close together into one JSON array
+            const messages = JSON.parse(text);
+            (Array.isArray(messages) ? messages : [messages]).forEach(handleServerMessage);
         };
 
         socket.onerror = (error) => {
@@ -83,7 +84,10 @@ document.addEventListener('DOMContentLoaded', () => {
                 addMessageToUI('تم إنهاء الاتصال. أعد تحميل الصفحة للمحاولة مرة أخرى.', 'agent status');
                 return;
             }
-            if (event.wasClean) {
+            if (event.code === 1013) {
+                // The server is already running its maximum number of agent sessions
+                addMessageToUI('الخادم مشغول حاليًا. حاول مرة أخرى بعد قليل.', 'agent error');
+            } else if (event.wasClean) {
                 addMessageToUI('انقطع الاتصال بالوكيل.', 'agent status');
             } else {
                 // Connection died, try to reconnect
@@ -98,6 +102,19 @@ document.addEventListener('DOMContentLoaded', () => {
         };
     }
 
+    function handleServerMessage(data) {
+        if (data.type === 'stream') {
+            appendStreamDelta(data.delta);
+            return;
+        }
+        endStream(); // The complete message replaces the live preview
+        if (data.type === 'pause') {
+            handlePause(data);
+        } else {
+            addMessageToUI(null, 'agent', data);
+        }
+    }
+
     // --- UI Functions ---
     function addMessageToUI(content, type, data = {}) {
         const messageDiv = document.createElement('div');
@@ -129,6 +146,23 @@ document.addEventListener('DOMContentLoaded', () => {
         messageList.scrollTop = messageList.scrollHeight;
     }
 
+    function appendStreamDelta(delta) {
+        if (!streamDiv) {
+            streamDiv = document.createElement('div');
+            streamDiv.classList.add('message', 'agent', 'thought');
+            messageList.appendChild(streamDiv);
+        }
+        streamDiv.textContent += delta;
+        messageList.scrollTop = messageList.scrollHeight;
+    }
+
+    function endStream() {
+        if (streamDiv) {
+            streamDiv.remove();
+            streamDiv = null;
+        }
+    }
+
     function handlePause(data) {
         pauseMessage.textContent = data.message || "توقف الوكيل مؤقتًا لتدخلك.";
         pauseOverlay.classList.remove('hidden');
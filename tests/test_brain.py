@@ -0,0 +1,210 @@
+import asyncio
+import re
+import pytest
+from backend.core import brain as brain_module
+from backend.core import llm as llm_module
+from backend.core.brain import Brain, AgentStep
+
+# --- Fixtures ---
+
+class FakeClient:
+    """Stands in for the LLM client, streaming a canned reply one token at a time."""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.calls = 0
+        self.summary_calls = 0
+        self.keep_tokens = None
+
+    async def count_tokens(self, text):
+        return None
+
+    async def stream_chat(self, model, messages, json_mode=False, temperature=0.1, keep_tokens=0):
+        self.calls += 1
+        self.keep_tokens = keep_tokens
+        for token in self.tokens:
+            yield token
+
+    async def chat(self, model, messages, json_mode=False, temperature=0.1, keep_tokens=0):
+        self.calls += 1
+        self.summary_calls += 1
+        return "".join(self.tokens)
+
+@pytest.fixture(autouse=True)
+def unmeasured_system_prompt(monkeypatch):
+    monkeypatch.setattr(brain_module, "_keep_tokens", None)
+
+@pytest.fixture
+def brain(monkeypatch):
+    monkeypatch.setattr(brain_module, "_response_cache", None)
+    b = Brain()
+    b.initialize_history()
+    b.add_user_message("List the files.")
+    return b
+
+# --- Step Tests ---
+
+async def test_step_parses_streamed_json(brain):
+    brain.client = FakeClient(['{"action": ', '"list_files", ', '"params": {}}'])
+    result = await brain.step()
+    assert result == AgentStep(action="list_files", params={})
+    assert brain.history[-1] == {"role": "assistant", "content": '{"action": "list_files", "params": {}}'}
+
+async def test_step_falls_back_to_thought(brain):
+    brain.client = FakeClient(["not ", "json"])
+    assert await brain.step() == AgentStep(thought="not json")
+
+async def test_step_treats_mistyped_reply_as_thought(brain):
+    brain.client = FakeClient(['{"action": 42}'])
+    assert await brain.step() == AgentStep(thought='{"action": 42}')
+
+async def test_step_forwards_growing_batches(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "STREAM_FLUSH_INTERVAL", float("inf"))
+    tokens = [str(i % 10) for i in range(20)]
+    brain.client = FakeClient(tokens)
+    deltas = []
+    async def on_delta(delta):
+        deltas.append(delta)
+    await brain.step(on_delta=on_delta)
+    assert [len(d) for d in deltas] == [1, 3, 9, 7]
+    assert "".join(deltas) == "".join(tokens)
+
+async def test_step_reuses_cached_reply(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "_response_cache", brain_module.TTLCache())
+    brain.client = FakeClient(['{"thought": "cached"}'])
+    history = list(brain.history)
+    first = await brain.step()
+    brain.history = history
+    second = await brain.step()
+    assert first == second == AgentStep(thought="cached")
+    assert brain.client.calls == 1
+
+async def test_semantic_cache_reuses_thoughts_but_not_actions(monkeypatch):
+    monkeypatch.setattr(brain_module, "_response_cache", brain_module.TTLCache())
+    monkeypatch.setattr(brain_module, "_semantic_index", brain_module.SemanticIndex(threshold=0.95))
+
+    class EmbeddingClient(FakeClient):
+        async def embed(self, model, text):
+            return [1.0, 0.0]  # Every task looks the same
+
+    async def first_step(task, reply):
+        b = Brain()
+        b.initialize_history()
+        b.add_user_message(task)
+        b.client = EmbeddingClient([reply])
+        return await b.step(), b.client.calls
+
+    await first_step("write 'x' to a.txt", '{"action": "write_file", "params": {"path": "a.txt", "content": "x"}}')
+    result, calls = await first_step("write 'y' to a.txt", '{"action": "write_file", "params": {"path": "a.txt", "content": "y"}}')
+    assert result.params["content"] == "y" and calls == 1
+    await first_step("plan a trip", '{"thought": "planning"}')
+    result, calls = await first_step("plan a trip!", '{"thought": "other"}')
+    assert result == AgentStep(thought="planning") and calls == 0
+
+async def test_step_keeps_the_system_prompt_estimate(brain):
+    brain.client = FakeClient(['{"thought": "ok"}'])
+    await brain.step()
+    # The estimate must not fall short of the prompt's word and punctuation pieces, which
+    # every tokenizer splits into at least one token each.
+    pieces = len(re.findall(r"\w+|[^\w\s]", brain_module.SYSTEM_PROMPT))
+    assert brain.client.keep_tokens == brain_module.SYSTEM_PROMPT_TOKENS >= pieces
+
+async def test_step_keeps_the_measured_system_prompt_once(brain):
+    class TokenizingClient(FakeClient):
+        async def count_tokens(self, text):
+            self.counted = getattr(self, "counted", 0) + 1
+            return 600
+    brain.client = TokenizingClient(['{"thought": "ok"}'])
+    await brain.step()
+    await brain.step()
+    assert brain.client.keep_tokens == 600 + brain_module.CHAT_TEMPLATE_TOKENS
+    assert brain.client.counted == 1
+
+async def test_steps_share_a_bounded_number_of_chat_slots(monkeypatch):
+    monkeypatch.setattr(brain_module, "_response_cache", None)
+    monkeypatch.setattr(llm_module, "_chat_slots", asyncio.Semaphore(2))
+    in_flight = max_in_flight = 0
+
+    class SlowClient(FakeClient):
+        async def stream_chat(self, *args, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            async for token in super().stream_chat(*args, **kwargs):
+                yield token
+
+    brains = []
+    for _ in range(5):
+        b = Brain()
+        b.initialize_history()
+        b.add_user_message("hi")
+        b.client = SlowClient(['{"thought": "ok"}'])
+        brains.append(b)
+    await asyncio.gather(*(b.step() for b in brains))
+    assert max_in_flight == 2
+
+# --- History Compaction Tests ---
+
+async def test_step_compacts_long_history(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "COMPACT_AFTER_MESSAGES", 6)
+    monkeypatch.setattr(brain_module, "KEEP_RECENT_MESSAGES", 2)
+    brain.client = FakeClient(['{"thought": "ok"}'])
+    for i in range(4):
+        await brain.step(f"result {i}")
+    await brain._compaction_task
+    # Five messages were folded into one summary; the last step's two messages were appended meanwhile.
+    assert len(brain.history) == 6
+    assert brain.history[1]["content"].startswith("Prior context summary:")
+    assert brain.history[-1]["role"] == "assistant"
+    assert brain._encoded == [brain_module.encode_message(m) for m in brain.history]
+
+async def test_large_tool_outputs_do_not_resummarize_every_step(brain):
+    brain.client = FakeClient(['{"thought": "ok"}'])
+    for i in range(11):
+        await brain.step("x" * 8000)
+        if brain._compaction_task is not None:
+            await brain._compaction_task
+    # 2000 estimated tokens per output: a summary is only due once four more outputs have
+    # aged out of the recent window, not on every step.
+    assert brain.client.summary_calls == 2
+
+async def test_close_cancels_pending_compaction(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "COMPACT_AFTER_MESSAGES", 4)
+    monkeypatch.setattr(brain_module, "KEEP_RECENT_MESSAGES", 2)
+    started = asyncio.Event()
+
+    class HangingClient(FakeClient):
+        async def chat(self, *args, **kwargs):
+            started.set()
+            await asyncio.sleep(3600)
+
+    brain.client = HangingClient(['{"thought": "ok"}'])
+    for i in range(3):
+        await brain.step(f"result {i}")
+    await started.wait()
+    brain.close()
+    with pytest.raises(asyncio.CancelledError):
+        await brain._compaction_task
+
+async def test_step_keeps_a_sliding_window_of_turns(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "COMPACT_AFTER_MESSAGES", 100)
+    monkeypatch.setattr(brain_module, "MAX_TURNS", 2)
+    brain.client = FakeClient(['{"thought": "ok"}'])
+    for i in range(4):
+        await brain.step(f"result {i}")
+    assert len(brain.history) == 5
+    assert brain.history[0]["role"] == "system"
+    assert brain.history[1] == {"role": "user", "content": "Tool output: result 2"}
+    assert brain._encoded == [brain_module.encode_message(m) for m in brain.history]
+
+async def test_sliding_window_keeps_the_summary(brain, monkeypatch):
+    monkeypatch.setattr(brain_module, "COMPACT_AFTER_MESSAGES", 100)
+    monkeypatch.setattr(brain_module, "MAX_TURNS", 1)
+    summary = {"role": "system", "content": brain_module.SUMMARY_PREFIX + "earlier work"}
+    brain.history = [brain.history[0], summary, *brain.history[1:]]
+    brain.client = FakeClient(['{"thought": "ok"}'])
+    for i in range(3):
+        await brain.step(f"result {i}")
+    assert brain.history[1] == summary
+    assert [m["content"] for m in brain.history[2:]] == ["Tool output: result 2", '{"thought": "ok"}']
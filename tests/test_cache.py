@@ -0,0 +1,53 @@
+import time
+from backend.core.cache import TTLCache, SemanticIndex, encode_message, history_key
+
+# --- TTLCache Tests ---
+
+def test_ttl_cache_returns_stored_value():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "reply")
+    assert cache.get("a") == "reply"
+    assert cache.get("missing") is None
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # "b" is now the least recently used entry
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    cache = TTLCache(maxsize=2, ttl=10)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("a", 1)
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+# --- Key and Semantic Lookup Tests ---
+
+def test_history_key_depends_on_model_and_history():
+    history = [encode_message({"role": "user", "content": "hi"})]
+    assert history_key("llama3", history) == history_key("llama3", [encode_message({"content": "hi", "role": "user"})])
+    assert history_key("llama3", history) != history_key("mistral", history)
+    assert history_key("llama3", history) != history_key("llama3", history * 2)
+
+def test_semantic_index_matches_only_above_threshold():
+    index = SemanticIndex(threshold=0.95)
+    index.add("scope", [1.0, 0.0], "cached")
+    assert index.lookup("scope", [0.99, 0.05]) == "cached"
+    assert index.lookup("scope", [0.0, 1.0]) is None
+    assert index.lookup("other-scope", [1.0, 0.0]) is None
+
+def test_semantic_index_returns_the_closest_entry_and_skips_zero_vectors():
+    index = SemanticIndex(threshold=0.5)
+    index.add("scope", [0.0, 0.0], "empty")
+    index.add("scope", [1.0, 1.0], "diagonal")
+    index.add("scope", [2.0, 0.1], "scaled")
+    assert len(index) == 2
+    assert index.lookup("scope", [1.0, 0.0]) == "scaled"
+    assert index.lookup("scope", [0.0, 0.0]) is None
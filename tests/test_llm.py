@@ -0,0 +1,136 @@
+import httpx
+import orjson
+import pytest
+from backend.core import llm
+from backend.core.llm import OllamaClient, LlamaServerClient
+
+# --- Fixtures ---
+
+def make_client(client_class, handler):
+    """Builds a client whose requests go to `handler` instead of the network."""
+    client = client_class("http://llm")
+    client._http = httpx.AsyncClient(base_url="http://llm", transport=httpx.MockTransport(handler))
+    return client
+
+class Recorder:
+    """Answers every request with a canned body and keeps the decoded request bodies."""
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append((request.url.path, orjson.loads(request.content)))
+        return httpx.Response(200, content=self.body)
+
+def ndjson(*parts) -> bytes:
+    return b"".join(orjson.dumps(part) + b"\n" for part in parts)
+
+def test_client_caps_only_the_connect_timeout():
+    timeout = OllamaClient("http://llm")._http.timeout
+    assert timeout.connect == llm.CONNECT_TIMEOUT
+    assert timeout.read is None and timeout.write is None and timeout.pool is None
+
+# --- Ollama Client Tests ---
+
+async def test_ollama_stream_chat_sends_options_and_yields_tokens():
+    recorder = Recorder(ndjson(
+        {"message": {"content": "he"}, "done": False},
+        {"message": {"content": ""}, "done": False},
+        {"message": {"content": "llo"}, "done": False},
+        {"message": {"content": ""}, "done": True},
+        {"message": {"content": "ignored"}, "done": False},
+    ))
+    client = make_client(OllamaClient, recorder)
+    messages = [{"role": "user", "content": "hi"}]
+    tokens = [token async for token in client.stream_chat("m", messages, json_mode=True, keep_tokens=7)]
+    assert tokens == ["he", "llo"]
+    assert recorder.requests == [("/api/chat", {
+        "model": "m", "messages": messages, "stream": True, "format": "json",
+        "options": {"temperature": 0.1, "num_keep": 7}, "keep_alive": llm.OLLAMA_KEEP_ALIVE,
+    })]
+
+async def test_ollama_stream_chat_raises_on_error_line():
+    recorder = Recorder(ndjson({"message": {"content": "he"}, "done": False}, {"error": "model crashed"}))
+    client = make_client(OllamaClient, recorder)
+    tokens = []
+    with pytest.raises(RuntimeError, match="model crashed"):
+        async for token in client.stream_chat("m", []):
+            tokens.append(token)
+    assert tokens == ["he"]
+
+async def test_ollama_chat_omits_optional_fields():
+    recorder = Recorder(orjson.dumps({"message": {"content": "summary"}, "done": True}))
+    client = make_client(OllamaClient, recorder)
+    assert await client.chat("m", []) == "summary"
+    path, body = recorder.requests[0]
+    assert path == "/api/chat"
+    assert "format" not in body
+    assert body["options"] == {"temperature": 0.1}
+    assert body["stream"] is False
+
+async def test_ollama_preload_and_embed():
+    recorder = Recorder(orjson.dumps({"embeddings": [[0.5, 0.25]]}))
+    client = make_client(OllamaClient, recorder)
+    await client.preload("m")
+    assert await client.embed("e", "text") == [0.5, 0.25]
+    assert recorder.requests == [
+        ("/api/chat", {"model": "m", "messages": [], "keep_alive": llm.OLLAMA_KEEP_ALIVE}),
+        ("/api/embed", {"model": "e", "input": "text"}),
+    ]
+
+async def test_ollama_count_tokens_is_unknown():
+    recorder = Recorder(b"{}")
+    client = make_client(OllamaClient, recorder)
+    assert await client.count_tokens("text") is None
+    assert recorder.requests == []
+
+async def test_ollama_http_errors_are_raised():
+    client = make_client(OllamaClient, lambda request: httpx.Response(404, json={"error": "model not found"}))
+    with pytest.raises(httpx.HTTPStatusError):
+        await client.chat("m", [])
+
+# --- llama-server Client Tests ---
+
+def sse(*chunks) -> bytes:
+    return b"".join(b"data: " + (chunk if isinstance(chunk, bytes) else orjson.dumps(chunk)) + b"\n\n" for chunk in chunks)
+
+async def test_llama_server_stream_chat_parses_events_until_done():
+    recorder = Recorder(b": keep-alive comment\n\n" + sse(
+        {"choices": [{"delta": {"role": "assistant"}}]},
+        {"choices": [{"delta": {"content": "he"}}]},
+        {"choices": [{"delta": {"content": "llo"}}]},
+        b"[DONE]",
+        {"choices": [{"delta": {"content": "ignored"}}]},
+    ))
+    client = make_client(LlamaServerClient, recorder)
+    messages = [{"role": "user", "content": "hi"}]
+    tokens = [token async for token in client.stream_chat("m", messages, json_mode=True, keep_tokens=7)]
+    assert tokens == ["he", "llo"]
+    assert recorder.requests == [("/v1/chat/completions", {
+        "model": "m", "messages": messages, "temperature": 0.1, "stream": True, "cache_prompt": True,
+        "response_format": {"type": "json_object"}, "n_keep": 7,
+    })]
+
+async def test_llama_server_chat_and_embed():
+    replies = iter([
+        orjson.dumps({"choices": [{"message": {"content": "summary"}}]}),
+        orjson.dumps({"data": [{"embedding": [0.5]}]}),
+    ])
+    requests = []
+    def handler(request):
+        requests.append((request.url.path, orjson.loads(request.content)))
+        return httpx.Response(200, content=next(replies))
+    client = make_client(LlamaServerClient, handler)
+    assert await client.chat("m", []) == "summary"
+    assert await client.embed("e", "text") == [0.5]
+    path, body = requests[0]
+    assert path == "/v1/chat/completions"
+    assert body["cache_prompt"] is True and body["stream"] is False
+    assert "response_format" not in body and "n_keep" not in body
+    assert requests[1] == ("/v1/embeddings", {"model": "e", "input": "text"})
+
+async def test_llama_server_count_tokens():
+    recorder = Recorder(orjson.dumps({"tokens": [1, 2, 3]}))
+    client = make_client(LlamaServerClient, recorder)
+    assert await client.count_tokens("text") == 3
+    assert recorder.requests == [("/tokenize", {"content": "text"})]
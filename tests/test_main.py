@@ -0,0 +1,191 @@
+import asyncio
+import time
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from backend import main
+from backend.core import llm
+from backend.core import brain as brain_module
+from backend.main import WSSender
+
+# --- Fixtures ---
+
+HANG = object()
+
+class FakeLLM:
+    """
+    Stands in for the LLM client. Each step streams the next scripted reply; HANG streams
+    one token and then waits until the step is cancelled.
+    """
+    def __init__(self):
+        self.replies = []
+        self.cancelled = 0
+
+    async def prewarm(self, connections):
+        pass
+
+    async def preload(self, model):
+        pass
+
+    async def count_tokens(self, text):
+        return None
+
+    async def stream_chat(self, model, messages, json_mode=False, temperature=0.1, keep_tokens=0):
+        reply = self.replies.pop(0)
+        if reply is not HANG:
+            yield reply
+            return
+        yield "{"
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    fake = FakeLLM()
+    monkeypatch.setattr(llm, "_client", fake)
+    monkeypatch.setattr(llm, "_chat_slots", None)
+    monkeypatch.setattr(brain_module, "_response_cache", None)
+    monkeypatch.setattr(brain_module, "_semantic_index", None)
+    monkeypatch.setattr(brain_module, "_keep_tokens", None)
+    return fake
+
+@pytest.fixture
+def client(fake_llm):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+def receive_until(websocket, predicate) -> list:
+    """Collects messages from the array frames until one matches `predicate`."""
+    messages = []
+    while not any(predicate(message) for message in messages):
+        messages.extend(orjson.loads(websocket.receive_bytes()))
+    return messages
+
+def is_status(text):
+    return lambda message: message.get("type") == "status" and message["message"] == text
+
+# --- WSSender Tests ---
+
+class RecordingWebSocket:
+    """Stands in for a WebSocket, keeping every binary frame sent."""
+    def __init__(self, fail: bool = False):
+        self.frames = []
+        self.fail = fail
+
+    async def send_bytes(self, data: bytes):
+        if self.fail:
+            raise RuntimeError("connection closed")
+        self.frames.append(orjson.loads(data))
+
+async def test_sender_batches_a_burst_into_one_array_frame():
+    websocket = RecordingWebSocket()
+    sender = WSSender(websocket)
+    sender.send({"type": "status", "message": "a"})
+    sender.send({"type": "status", "message": "b"})
+    sender.send_encoded(b'{"type":"status","message":"c"}')
+    await asyncio.sleep(0.05)
+    assert websocket.frames == [[
+        {"type": "status", "message": "a"},
+        {"type": "status", "message": "b"},
+        {"type": "status", "message": "c"},
+    ]]
+    await sender.close()
+
+async def test_sender_close_flushes_queued_messages():
+    websocket = RecordingWebSocket()
+    sender = WSSender(websocket)
+    sender.send({"type": "status", "message": "last"})
+    await sender.close()
+    assert websocket.frames == [[{"type": "status", "message": "last"}]]
+
+async def test_sender_drops_messages_after_a_send_error():
+    sender = WSSender(RecordingWebSocket(fail=True))
+    sender.send({"type": "status", "message": "lost"})
+    await asyncio.sleep(0.05)
+    sender.send({"type": "status", "message": "also lost"})
+    # The background task has stopped; closing must not wait for it to drain the queue.
+    await asyncio.wait_for(sender.close(), timeout=1)
+
+# --- Startup Tests ---
+
+def test_startup_does_not_wait_for_the_model_server(fake_llm, monkeypatch):
+    started = []
+    async def unreachable(connections):
+        started.append(connections)
+        await asyncio.sleep(3600)
+    monkeypatch.setattr(fake_llm, "prewarm", unreachable)
+    began = time.monotonic()
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws/execute_task") as websocket:
+            websocket.send_text("stop")
+            receive_until(websocket, is_status("Agent stopped by user."))
+    assert time.monotonic() - began < 5
+    assert started == [main.LLM_PARALLEL_REQUESTS]
+
+# --- Session Tests ---
+
+def test_session_runs_a_task_and_stops(client, fake_llm):
+    fake_llm.replies = ['{"thought": "looking"}', '{"action": "finish_task", "params": {"reason": "done"}}']
+    with client.websocket_connect("/ws/execute_task") as websocket:
+        websocket.send_text("do it")
+        messages = receive_until(websocket, lambda message: message.get("action") == "finish_task")
+        assert {"thought": "looking"} in messages
+        websocket.send_text("stop")
+        receive_until(websocket, is_status("Agent stopped by user."))
+
+def test_new_message_cancels_the_running_step(client, fake_llm):
+    fake_llm.replies = [HANG]
+    with client.websocket_connect("/ws/execute_task") as websocket:
+        websocket.send_text("first task")
+        receive_until(websocket, lambda message: message.get("type") == "stream")
+        websocket.send_text("second task")
+        receive_until(websocket, is_status("Received new instruction, replanning..."))
+        websocket.send_text("stop")
+        receive_until(websocket, is_status("Agent stopped by user."))
+    assert fake_llm.cancelled == 1
+
+def test_message_sent_during_a_tool_replans_without_a_new_step(client, fake_llm, monkeypatch):
+    fake_llm.replies = ['{"action": "list_files", "params": {}}']
+    steps = []
+    step = main.Brain.step
+    def counting_step(self, *args, **kwargs):
+        steps.append(args)
+        return step(self, *args, **kwargs)
+    async def slow_tool(self, tool_name, params):
+        await asyncio.sleep(0.3)
+        return "file.txt"
+    monkeypatch.setattr(main.Brain, "step", counting_step)
+    monkeypatch.setattr(main.Toolbox, "execute_tool", slow_tool)
+    with client.websocket_connect("/ws/execute_task") as websocket:
+        websocket.send_text("list files")
+        receive_until(websocket, lambda message: message.get("action") == "list_files")
+        websocket.send_text("something else")
+        messages = receive_until(websocket, is_status("Received new instruction, replanning..."))
+        assert {"type": "action_result", "output": "file.txt"} in messages
+        websocket.send_text("stop")
+        receive_until(websocket, is_status("Agent stopped by user."))
+    assert len(steps) == 1
+
+def test_session_over_the_limit_is_rejected_until_a_slot_is_released(fake_llm, monkeypatch):
+    monkeypatch.setattr(main, "MAX_AGENTS", 1)
+    fake_llm.replies = [HANG]
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/ws/execute_task") as websocket:
+            websocket.send_text("long task")
+            receive_until(websocket, lambda message: message.get("type") == "stream")
+            with client.websocket_connect("/ws/execute_task") as rejected:
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    rejected.receive_bytes()
+            assert closed.value.code == 1013
+        # Closing the socket cancels the hung step; `finally` must give the slot back.
+        deadline = time.monotonic() + 5
+        while main.app.state.agent_sem.locked() or not fake_llm.cancelled:
+            assert time.monotonic() < deadline, "agent slot or hung step was never released"
+            time.sleep(0.01)
+        with client.websocket_connect("/ws/execute_task") as websocket:
+            websocket.send_text("stop")
+            receive_until(websocket, is_status("Agent stopped by user."))